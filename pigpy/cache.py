@@ -0,0 +1,141 @@
+"""Persistent cache of intermediate reports, shared between plan runs"""
+
+import os
+import re
+import json
+import logging
+from hashlib import sha1
+from time import time
+
+from pigpy.hadoop import HDFSError
+
+LOAD_PATH = re.compile(r"\bLOAD\s+'([^']*)'", re.IGNORECASE)
+
+class MaterializationCache(object):
+    """Keeps cached reports in a stable HDFS folder between runs.
+
+    Every cached report is stored under a fingerprint of its code, the fingerprints
+    of its parents and the modification times of the files it loads. When a later
+    plan needs a report with the same fingerprint, it loads the stored results
+    instead of computing the report and everything above it.
+
+    The index of stored reports is kept in a local json file. Entries older than
+    max_age seconds are removed, and the least recently used entries are removed
+    until the cache is smaller than max_size bytes.
+    """
+    def __init__(self, hadoop, hdfs_directory, index_filename, max_age=None, max_size=None):
+        self.log = logging.getLogger(__name__)
+        self.__hadoop = hadoop
+        self.__hdfs_directory = hdfs_directory
+        self.__index_filename = index_filename
+        self.__max_age = max_age
+        self.__max_size = max_size
+        self.__index = self.__read_index()
+
+    def __read_index(self):
+        if not os.path.exists(self.__index_filename):
+            return {}
+        index_file = open(self.__index_filename)
+        try:
+            return json.load(index_file)
+        finally:
+            index_file.close()
+
+    def save(self):
+        """Write the index back to the local filesystem"""
+        index_file = open(self.__index_filename, "w")
+        try:
+            json.dump(self.__index, index_file, indent=1, sort_keys=True)
+        finally:
+            index_file.close()
+
+    def __input_signature(self, path, signatures):
+        if path not in signatures:
+            try:
+                signatures[path] = self.__hadoop.stat(path)
+            except HDFSError:
+                #Missing inputs (or globs stat can't handle) just never match a stored mtime
+                self.log.info("Could not find modification time for %s" % path)
+                signatures[path] = None
+        return signatures[path]
+
+    def fingerprints(self, sorted_reports, storage=""):
+        """Return a dict of report to fingerprint.
+
+        sorted_reports must have parents before children, as Plan sorts them. storage
+        is the format the reports get stored with, since loading them depends on it.
+        """
+        fingerprints = {}
+        signatures = {}
+        for report in sorted_reports:
+            digest = sha1()
+            for part in [storage, report.code, str(report.cache_columns)]:
+                digest.update(part)
+                digest.update("\0")
+            for parent_fingerprint in sorted(fingerprints[parent] for parent in report.parents):
+                digest.update(parent_fingerprint)
+            for path in LOAD_PATH.findall(report.code):
+                digest.update("%s\0%s\0" % (path, self.__input_signature(path, signatures)))
+            fingerprints[report] = digest.hexdigest()
+        return fingerprints
+
+    def path_for(self, fingerprint):
+        """HDFS path a report with this fingerprint gets stored to"""
+        return os.path.join(self.__hdfs_directory, fingerprint)
+
+    def lookup(self, fingerprint):
+        """Return the HDFS path of stored results for fingerprint, or None"""
+        entry = self.__index.get(fingerprint)
+        if entry is None:
+            return None
+        entry["last_used"] = time()
+        return entry["path"]
+
+    def commit(self, fingerprint, report_name):
+        """Record that the report with fingerprint has been stored by a finished job"""
+        path = self.path_for(fingerprint)
+        try:
+            size = self.__hadoop.dus(path)
+        except HDFSError:
+            self.log.warning("Cached report %s was not found at %s" % (report_name, path))
+            return
+        now = time()
+        self.__index[fingerprint] = {
+            "path": path,
+            "report": report_name,
+            "size": size,
+            "created": now,
+            "last_used": now,
+        }
+
+    def __remove(self, fingerprint):
+        entry = self.__index.pop(fingerprint)
+        self.log.debug("Evicting cached report %s from %s" % (entry["report"], entry["path"]))
+        try:
+            self.__hadoop.rmr(entry["path"])
+        except HDFSError:
+            self.log.info("Could not find %s for removal." % entry["path"])
+
+    def evict(self):
+        """Remove entries that are too old, then the least recently used until small enough"""
+        if self.__max_age is not None:
+            oldest = time() - self.__max_age
+            for fingerprint, entry in self.__index.items():
+                if entry["created"] < oldest:
+                    self.__remove(fingerprint)
+
+        if self.__max_size is not None:
+            by_last_use = sorted(self.__index.items(), key=lambda item: item[1]["last_used"])
+            total_size = sum(entry["size"] for fingerprint, entry in by_last_use)
+            for fingerprint, entry in by_last_use:
+                if total_size <= self.__max_size:
+                    break
+                total_size -= entry["size"]
+                self.__remove(fingerprint)
+        self.save()
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.__index
+
+    def __len__(self):
+        return len(self.__index)
@@ -4,8 +4,10 @@ import sys
 import os
 import subprocess
 import logging
-import tempfile
-import shutil
+import gzip
+
+#Size of the blocks reports are copied in when streaming them out of the HDFS
+COPY_BUFFER_SIZE = 1024 * 1024
 
 class HDFSError(StandardError):
     pass
@@ -32,6 +34,18 @@ class Hadoop(object):
         result.wait()
         return result.returncode
 
+    def __stream_from_command_line(self, command):
+        """Start command and return the running process, with its output on a pipe"""
+        self.log.debug(command)
+        return subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=COPY_BUFFER_SIZE)
+
+    def __read_from_command_line(self, command):
+        """Run command and return its return code and standard output"""
+        self.log.debug(command)
+        result = subprocess.Popen(command, stdout=subprocess.PIPE)
+        output = result.communicate()[0]
+        return result.returncode, output
+
 
 #HDFS Commands
 
@@ -41,17 +55,26 @@ class Hadoop(object):
         Eventually, we will probably want to wrap libhdfs.so using SWIG
         """
 
+        returncode = self.__send_to_command_line(self.__hdfs_command(hdfs_command, args))
+        if returncode != 0:
+            raise HDFSError("hdfs command returned error code %s" % returncode)
+
+    def read_hdfs_command(self, hdfs_command, *args):
+        """Run an hdfs command and return what it printed"""
+        returncode, output = self.__read_from_command_line(
+            self.__hdfs_command(hdfs_command, args))
+        if returncode != 0:
+            raise HDFSError("hdfs command returned error code %s" % returncode)
+        return output
+
+    def __hdfs_command(self, hdfs_command, args):
         common_prefix = [
             os.path.join(self.__local_home, "bin", "hadoop"), #The hadoop binary
             "dfs",
             "-fs", #fs specifies the hadoop filesystem to connect to
             self.__name_node
         ]
-        command = common_prefix + [hdfs_command] + list(args)
-        
-        returncode = self.__send_to_command_line(command)
-        if returncode != 0:
-            raise HDFSError("hdfs command returned error code %s" % returncode)
+        return common_prefix + [hdfs_command] + list(args)
     
     def copyFromLocal(self, src, dest):
         """Find src on the local filesystem and copy it to dest on the hdfs"""
@@ -75,6 +98,38 @@ class Hadoop(object):
             #If test had a non-zero return code, the path exists
             return True
             
+    def cat(self, path, destination):
+        """Write the contents of path on the HDFS to the open file destination.
+
+        The data is streamed straight from hadoop in large blocks, without touching the
+        local disk. path may be a glob, in which case all matching files are written in
+        the order hadoop lists them. Returns the number of bytes written.
+        """
+        result = self.__stream_from_command_line(self.__hdfs_command("-cat", [path]))
+        size = 0
+        try:
+            while True:
+                block = result.stdout.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                destination.write(block)
+                size += len(block)
+        finally:
+            result.stdout.close()
+            result.wait()
+        if result.returncode != 0:
+            raise HDFSError("hdfs command returned error code %s" % result.returncode)
+        return size
+
+    def stat(self, path):
+        """Return the modification time of path on the HDFS, as printed by hadoop"""
+        return self.read_hdfs_command("-stat", path).strip()
+
+    def dus(self, path):
+        """Return the total size in bytes of the file or folder tree at path"""
+        output = self.read_hdfs_command("-dus", path)
+        return int(output.split()[-1])
+
     def rm(self, path):
         """Remove the file at path on the HDFS"""
         self.run_hdfs_command("-rm", path)
@@ -85,36 +140,38 @@ class Hadoop(object):
 
 #Pig Commands
 
-    def copy_pig_report_to_file(self, report_path, local_filename, header=None):
+    def copy_pig_report_to_file(self, report_path, local_filename, header=None, compress=False):
         """Copies a pig report from the HDFS to local_filename.
         
-        First all output files for the pig reports are pulled from HDFS, then they
-        get concatenated at the final location. An optional header can be supplied.
-        While this can be any string, the purpose is to allow column headers for the report.
+        The output files for the pig report are streamed from HDFS straight into
+        local_filename, gzipped on the way if compress is True. An optional header can
+        be supplied. While this can be any string, the purpose is to allow column
+        headers for the report. Returns the number of bytes in the report.
         """
-        
-        #First we get all the part files to a temp directory
-        temp_directory = tempfile.mkdtemp(dir="/tmp")
         if self.test(report_path, isDirectory=True):
-            self.copyToLocal(os.path.join(report_path, "part*"), temp_directory)
+            source = os.path.join(report_path, "part*")
         else:
-            self.copyToLocal(report_path, temp_directory)
-    
-        #Now we read all files in the temp directory and smash them together to make the final results
-        local_file = open(local_filename, "w")
-        if header is not None:
-            local_file.write(header + "\n")
-        for filename in os.listdir(temp_directory):
-            for line in open(os.path.join(temp_directory, filename)):
-                local_file.write(line)
+            source = report_path
+
+        if compress:
+            local_file = gzip.open(local_filename, "wb")
+        else:
+            local_file = open(local_filename, "wb")
+        try:
+            size = 0
+            if header is not None:
+                local_file.write(header + "\n")
+                size += len(header) + 1
+            size += self.cat(source, local_file)
+        except:
+            #Don't leave a partial report behind
+            local_file.close()
+            os.remove(local_filename)
+            raise
+        local_file.close()
         
         self.log.debug("Wrote pig report to %s" % local_filename)
-        
-        #finally, clean up after ourselves (rmtree doesn't care if the dir is empty)
-        if os.path.exists(temp_directory):
-            shutil.rmtree(temp_directory)
-        else:
-            self.log.info("Could not find %s for removal." % temp_directory)
+        return size
 
     def get_classpaths(self):
         """Return all paths java will need to run pig."""
@@ -5,19 +5,66 @@ import unittest
 import re
 import logging
 import shutil
+import threading
+import Queue
 from time import time
 
+def _map_concurrently(function, items, max_workers):
+    """Call function on every item using up to max_workers threads, waiting for all of them.
+
+    function is expected to deal with its own errors.
+    """
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            function(item)
+        return
+
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            function(item)
+
+    workers = [threading.Thread(target=worker) for i in range(min(max_workers, len(items)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+class SaveReportsError(StandardError):
+    """Some reports could not be pulled out of the HDFS.
+
+    results has the outcome of every report, as returned by PlanRunner.save_reports
+    """
+    def __init__(self, results):
+        self.results = results
+        failed = sorted(name for name, result in results.iteritems() if result["error"])
+        super(SaveReportsError, self).__init__("Could not save reports: %s" % ", ".join(failed))
+
 class Report(object):
     #TODO: figure out more elegant way to manage this. global state=yuck
     __reports = {}
+    #Registered reports keyed by structure, so duplicates are found without building code
+    __signatures = {}
+    #Next subscript to try for each base name
+    __subscripts = {}
     
     @classmethod
     def reset_reports(klass):
         klass.__reports = {}
+        klass.__signatures = {}
+        klass.__subscripts = {}
     
     @classmethod
-    def __register_report(klass, report):
+    def __register_report(klass, report, signature):
         klass.__reports[report.name] = report
+        klass.__signatures[signature] = report
 
     @classmethod
     def __build_code(klass, name, raw_code, parents):
@@ -27,21 +74,30 @@ class Report(object):
         return raw_code % dictparams
 
     @classmethod
-    def __correct_name_for_report(klass, name, raw_code, parents):
-        subscript = 1
-        test_name = name
+    def __signature(klass, name, raw_code, parents):
+        """Key identifying a report by its requested name, raw code and parent objects.
+
+        Two reports with the same signature always generate the same pig code.
+        """
+        parent_ids = sorted((key, id(parent)) for key, parent in parents.iteritems())
+        return (name, raw_code, tuple(parent_ids))
+
+    @classmethod
+    def __correct_name_for_report(klass, name, signature):
+        registered_report = klass.__signatures.get(signature)
+        if registered_report is not None:
+            return registered_report.name #These are in fact the same report
+        if name not in klass.__reports:
+            #No report with the same name
+            return name
+
+        #Start probing where the last report with this name left off
+        subscript = klass.__subscripts.get(name, 1)
+        test_name = "%s_%s" % (name, subscript)
         while test_name in klass.__reports:
-            registered_report = klass.__reports[name]
-            
-            #Check to see if the code and the parents are identical
-            if (registered_report.code == klass.__build_code(name, raw_code, parents)
-                and sorted(registered_report.parents) == 
-                    [p for p in sorted(parents.itervalues())]):
-                return test_name #These are in fact the same report
-            
-            test_name = "%s_%s" % (name, subscript)
             subscript += 1
-        #No report with the same name
+            test_name = "%s_%s" % (name, subscript)
+        klass.__subscripts[name] = subscript + 1
         return test_name
     
     def __init__(self, name, code, parents=None, cache_columns=None, human_readable_columns=None):
@@ -58,22 +114,19 @@ class Report(object):
         self.__uniquify_report(name)
         
     def __uniquify_report(self, name):
-        self.__name = self.__class__.__correct_name_for_report(
-            name, 
-            self.__raw_code,
-            self.__parents
-        )
+        signature = self.__class__.__signature(name, self.__raw_code, self.__parents)
+        self.__name = self.__class__.__correct_name_for_report(name, signature)
         self.__code = self.__class__.__build_code(
             self.__name, 
             self.__raw_code,
             self.__parents
         )
         
-        if self.name in self.__class__.__reports:
+        if signature in self.__class__.__signatures:
             #This report is a duplicate of another, make them the same
-            self = self.__class__.__reports[self.name]
+            self = self.__class__.__signatures[signature]
         else:
-            self.__class__.__register_report(self)
+            self.__class__.__register_report(self, signature)
 
     def request_caching(self):
         """Call this to force caching of this report."""
@@ -97,67 +150,151 @@ class Report(object):
     parents = property(lambda self: [parent for parent in self.__parents.itervalues()])
     
 class Plan(object):
-    def __init__(self, output_directory="/tmp", reports=None, save_format="USING PigStorage(',')"):
+    def __init__(self, output_directory="/tmp", reports=None, save_format="USING PigStorage(',')",
+                 cache=None):
         #TODO: create utility function that give back appropriate handlers
         #logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
         self.log = logging.getLogger(__name__)
         self.__reports = reports or []
         self.__save_format = save_format
         self.output_directory =  os.path.join(output_directory, str(time()))
-        
+        #Optional pigpy.cache.MaterializationCache to keep cached reports between runs
+        self.__cache = cache
+        self.__cache_entries = []
+        #The generated pigfile, rebuilt only when the set of reports changes
+        self.__pigfile = None
         
     def add(self, report):
         self.__reports.append(report)
+        self.__pigfile = None
         
-    def __save_or_cache_report(self, report, pigfile):
-        if report in self.__reports or (report.needs_cache and report.cache_columns):
-            report_path = os.path.join(self.output_directory, report.name)
-            
-            pigfile += "\nSTORE %(report)s INTO '%(report_path)s' %(save_format)s;\n" % {
-                    "report": report,
-                    "report_path": report_path,
-                    "save_format": self.__save_format,
-            }
+    def __store_line(self, report, path):
+        return "\nSTORE %(report)s INTO '%(report_path)s' %(save_format)s;\n" % {
+                "report": report,
+                "report_path": path,
+                "save_format": self.__save_format,
+        }
+
+    def __load_line(self, report, path):
+        return "%(report)s = LOAD '%(report_path)s' %(save_format)s AS (%(columns)s);\n" % {
+            "report": report, 
+            "report_path": path,
+            "columns": report.cache_columns,
+            "save_format": self.__save_format,
+        }
+
+    def __save_or_cache_report(self, report, lines, outputs, cache_path=None):
+        """Add the STORE and LOAD statements report needs after its code.
+
+        Cached reports are reloaded from cache_path when given, otherwise from
+        wherever they were saved in the output directory.
+        """
+        stored_path = None
+        if report in outputs:
+            stored_path = os.path.join(self.output_directory, report.name)
+            lines.append(self.__store_line(report, stored_path))
 
         if report.needs_cache and report.cache_columns:
-            pigfile += "%(report)s = LOAD '%(report_path)s' %(save_format)s AS (%(columns)s);\n" % {
-                "report": report, 
-                "report_path": report_path,
-                "columns": report.cache_columns,
-                "save_format": self.__save_format,
-            }
+            if cache_path is not None:
+                stored_path = cache_path
+                lines.append(self.__store_line(report, stored_path))
+            elif stored_path is None:
+                stored_path = os.path.join(self.output_directory, report.name)
+                lines.append(self.__store_line(report, stored_path))
+            lines.append(self.__load_line(report, stored_path))
 
         if report.needs_cache and not report.cache_columns:
             self.log.warning("Report %s should be cached, but does not have cache_columns" % report)
 
-        return pigfile
-        
-    def __get_pigfile(self):
-        #Create sorted list of statement dependencies
+    def __sort_reports(self):
+        """Return every report needed by the plan, with parents before their children.
+
+        This is an iterative depth first search, so deep dependency chains do not hit
+        the recursion limit. Any report reached more than once is asked to cache itself.
+        """
         sorted_reports = []
-        #Get to cheat a little - this should proabbly be topographical sort
-        #But we just have to make sure dependencies are run first
-        #TODO:remove deps as an argument. My recursive brain appears to be absent today.
-        def add_sorted_deps(reports, deps):
-            for report in reports:
-                if report not in deps:
-                    self.log.debug("Adding parents for %s" % report)
-                    add_sorted_deps(report.parents, deps)
-                    self.log.debug("Adding report %s" % report)
-                    deps.append(report)
+        seen = set()
+        #Each stack frame is a report and an iterator over the reports it still needs
+        stack = [(None, iter(self.__reports))]
+        while stack:
+            report, pending = stack[-1]
+            for dependency in pending:
+                if dependency in seen:
+                    #We need this report more than once, so cache the results
+                    self.log.debug("Cacheing report %s" % dependency)
+                    dependency.request_caching()
                 else:
-                    #We need this report more than once, so cache teh results
-                    self.log.debug("Cacheing report %s" % report)
-                    report.request_caching()
-            
-        add_sorted_deps(self.__reports, sorted_reports)
-        
-        pigfile = ""
-        for report in sorted_reports:
-            pigfile += report.code + "\n"
-            pigfile = self.__save_or_cache_report(report, pigfile)
-            
-        return pigfile
+                    self.log.debug("Adding parents for %s" % dependency)
+                    seen.add(dependency)
+                    stack.append((dependency, iter(dependency.parents)))
+                    break
+            else:
+                #All dependencies have been added, so this report can follow them
+                stack.pop()
+                if report is not None:
+                    self.log.debug("Adding report %s" % report)
+                    sorted_reports.append(report)
+        return sorted_reports
+
+    def __live_reports(self, sorted_reports, loaded):
+        """Filter sorted_reports down to those the plan still needs to compute or load.
+
+        Reports in loaded come from the materialization cache, so their parents are
+        only needed if something else uses them.
+        """
+        live = set()
+        stack = list(self.__reports)
+        while stack:
+            report = stack.pop()
+            if report not in live:
+                live.add(report)
+                if report not in loaded:
+                    stack.extend(report.parents)
+        return [report for report in sorted_reports if report in live]
+
+    def __get_pigfile(self):
+        if self.__pigfile is None:
+            sorted_reports = self.__sort_reports()
+            outputs = set(self.__reports)
+            fingerprints = {}
+            loaded = set()
+            self.__cache_entries = []
+            if self.__cache is not None:
+                fingerprints = self.__cache.fingerprints(sorted_reports, self.__save_format)
+                loaded = set(report for report in sorted_reports
+                    if report.cache_columns and fingerprints[report] in self.__cache)
+                sorted_reports = self.__live_reports(sorted_reports, loaded)
+
+            lines = []
+            for report in sorted_reports:
+                if report in loaded:
+                    self.log.debug("Loading report %s from the materialization cache" % report)
+                    lines.append(self.__load_line(report, 
+                        self.__cache.lookup(fingerprints[report])))
+                    if report in outputs:
+                        lines.append(self.__store_line(report,
+                            os.path.join(self.output_directory, report.name)))
+                    continue
+
+                cache_path = None
+                if report in fingerprints and report.needs_cache and report.cache_columns:
+                    cache_path = self.__cache.path_for(fingerprints[report])
+                    self.__cache_entries.append((fingerprints[report], report.name))
+                lines.append(report.code + "\n")
+                self.__save_or_cache_report(report, lines, outputs, cache_path)
+            self.__pigfile = "".join(lines)
+        return self.__pigfile
+
+    def commit(self):
+        """Record a successful run of the pigfile.
+
+        Reports stored for the materialization cache get added to its index, and
+        old entries are evicted.
+        """
+        if self.__cache is not None:
+            for fingerprint, report_name in self.__cache_entries:
+                self.__cache.commit(fingerprint, report_name)
+            self.__cache.evict()
     
     pigfile = property(__get_pigfile)
     reports = property(lambda self: self.__reports)
@@ -165,6 +302,7 @@ class Plan(object):
 
 class PlanRunner(object):
     def __init__(self, plan, hadoop_wrapper):
+        self.log = logging.getLogger(__name__)
         self._plan = plan
         self.__hadoop = hadoop_wrapper
 
@@ -178,13 +316,35 @@ class PlanRunner(object):
         try:
             #submit the job to Hadoop
             self.__hadoop.run_pig_job(report_filename)
+            self._plan.commit()
         finally:
             #Remove the report file
             if cleanup:
                 if os.path.exists(report_filename):
                     os.remove(report_filename)
 
-    def save_reports(self, folder, header_lookup={}, over_write=True):
+    def __fetch_report(self, fetch, results, lock):
+        name, remote_path, local_path, header = fetch
+        result = {"bytes": 0, "seconds": 0.0, "error": None}
+        start = time()
+        try:
+            result["bytes"] = self.__hadoop.copy_pig_report_to_file(remote_path, local_path,
+                header=header)
+        except Exception, e:
+            self.log.exception("Could not save report %s" % name)
+            result["error"] = e
+        result["seconds"] = time() - start
+        with lock:
+            results[name] = result
+
+    def save_reports(self, folder, header_lookup={}, over_write=True, max_workers=1):
+        """Pull every report in the plan out of the HDFS into folder.
+
+        Up to max_workers reports are downloaded at the same time. A failed report does
+        not stop the others. Returns a dict of report name to the bytes saved, seconds
+        taken and error for each report, and raises SaveReportsError with the same dict
+        if any report failed.
+        """
         if os.path.exists(folder):
             #We want to move the old folder if it exists
             if folder.endswith("/"):
@@ -194,6 +354,7 @@ class PlanRunner(object):
             else:
                 shutil.move(folder, "%s-%s.old" % (folder, str(time())))
         os.makedirs(folder)
+        fetches = []
         for report in self._plan.reports:
             name = report.name
             header = report.human_readable_columns
@@ -203,7 +364,20 @@ class PlanRunner(object):
             #pull the reports out of Hadoop
             local_path = os.path.join(folder, name)
             remote_path = os.path.join(self._plan.output_directory, name)
-            self.__hadoop.copy_pig_report_to_file(remote_path, local_path, header=header)
+            fetches.append((name, remote_path, local_path, header))
+
+        results = {}
+        lock = threading.Lock()
+        _map_concurrently(lambda fetch: self.__fetch_report(fetch, results, lock),
+            fetches, max_workers)
+
+        for name, remote_path, local_path, header in fetches:
+            result = results[name]
+            self.log.info("Saved report %s: %s bytes in %.2f seconds%s" % (
+                name, result["bytes"], result["seconds"], result["error"] and " (failed)" or ""))
+        if [result for result in results.itervalues() if result["error"]]:
+            raise SaveReportsError(results)
+        return results
 
     def cleanup(self):
         """Clean up data in the HDFS"""
@@ -0,0 +1,62 @@
+"""Stand-in for bin/hadoop that serves dfs commands from the local filesystem.
+
+Only understands "hadoop dfs -fs <name node> <command> <args>". -test answers the
+way the hadoop version pigpy.hadoop.Hadoop.test was written against does, with a
+non-zero return code when the path passes the test.
+"""
+import sys
+import os
+import glob
+import shutil
+import time
+
+def expand(path):
+    paths = sorted(glob.glob(path))
+    if not paths:
+        sys.stderr.write("cat: File does not exist: %s\n" % path)
+        sys.exit(255)
+    return paths
+
+def dfs(command, args):
+    if command == "-cat":
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        for path in expand(args[0]):
+            source = open(path, "rb")
+            shutil.copyfileobj(source, out)
+            source.close()
+    elif command == "-test":
+        flag, path = args
+        passed = os.path.isdir(path) if flag == "-d" else os.path.exists(path)
+        return passed and 1 or 0
+    elif command == "-copyToLocal":
+        for path in expand(args[0]):
+            shutil.copy(path, args[1])
+    elif command == "-copyFromLocal":
+        shutil.copy(args[0], args[1])
+    elif command == "-rm":
+        os.remove(expand(args[0])[0])
+    elif command == "-rmr":
+        for path in expand(args[0]):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    elif command == "-stat":
+        mtime = os.path.getmtime(expand(args[0])[0])
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime)))
+    elif command == "-dus":
+        path = expand(args[0])[0]
+        size = 0
+        for root, dirs, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        if os.path.isfile(path):
+            size = os.path.getsize(path)
+        print("%s\t%s" % (path, size))
+    else:
+        sys.stderr.write("Unknown command %s\n" % command)
+        return 255
+    return 0
+
+if __name__ == "__main__":
+    #argv is dfs -fs <name node> <command> <args>
+    sys.exit(dfs(sys.argv[4], sys.argv[5:]))
@@ -0,0 +1,96 @@
+import sys
+import os
+import unittest
+import re
+import shutil
+import tempfile
+
+from pigpy.reports import Report, Plan
+from pigpy.cache import MaterializationCache
+
+class FakeHadoop(object):
+    def __init__(self):
+        self.mtimes = {}
+        self.removed = []
+
+    def stat(self, path):
+        return self.mtimes.get(path, "2009-06-01 12:00:00")
+
+    def dus(self, path):
+        return 100
+
+    def rmr(self, path):
+        self.removed.append(path)
+
+class test_cache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.directory, "index.json")
+        self.hadoop = FakeHadoop()
+
+        self.slow_report = Report("slow_aggregate",
+            "%(this)s = LOAD 'census.tsv' AS (age, state);\n%(this)s = SLOW_UDF(%(this)s);",
+            cache_columns="age, state")
+        self.children = [
+            Report("state_%s" % state,
+                "%%(this)s = FILTER %%(demo)s BY state == '%s';" % state,
+                parents={"demo": self.slow_report})
+            for state in ["michigan", "ohio"]
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self, **kwargs):
+        return MaterializationCache(self.hadoop, "/cache", self.index_filename, **kwargs)
+
+    def run_plan(self, cache):
+        plan = Plan(reports=list(self.children), cache=cache)
+        pigfile = plan.pigfile
+        plan.commit()
+        return pigfile
+
+    def test_cached_report_is_stored_in_the_cache_directory(self):
+        pigfile = self.run_plan(self.cache())
+
+        self.failUnless(re.match(".*SLOW_UDF.*STORE slow_aggregate INTO '/cache/.*"
+            "slow_aggregate = LOAD '/cache/.*", pigfile, flags=re.DOTALL),
+            "Report should be stored to and loaded from the cache, pigfile is:\n%s" % pigfile
+        )
+
+    def test_next_run_loads_cached_report_instead_of_computing_it(self):
+        self.run_plan(self.cache())
+        pigfile = self.run_plan(self.cache())
+
+        self.failIf("SLOW_UDF" in pigfile,
+            "Cached report should not be computed again, pigfile is:\n%s" % pigfile)
+        self.failUnless(re.match("slow_aggregate = LOAD '/cache/.*AS \(age, state\).*"
+            "state_michigan.*state_ohio", pigfile, flags=re.DOTALL),
+            "Cached report should be loaded first, pigfile is:\n%s" % pigfile)
+
+    def test_changed_input_is_not_loaded_from_cache(self):
+        self.run_plan(self.cache())
+        self.hadoop.mtimes["census.tsv"] = "2009-06-02 12:00:00"
+        pigfile = self.run_plan(self.cache())
+
+        self.failUnless("SLOW_UDF" in pigfile,
+            "Report with changed input should be computed, pigfile is:\n%s" % pigfile)
+
+    def test_old_entries_are_evicted(self):
+        self.run_plan(self.cache())
+        cache = self.cache(max_age=-1)
+        cache.evict()
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(len(self.hadoop.removed), 1)
+        self.assertEqual(len(self.cache()), 0)
+
+    def test_entries_are_evicted_until_cache_is_small_enough(self):
+        self.run_plan(self.cache())
+        cache = self.cache(max_size=100)
+        cache.evict()
+        self.assertEqual(len(cache), 1)
+
+        cache = self.cache(max_size=99)
+        cache.evict()
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,50 @@
+import sys
+import os
+import unittest
+import gzip
+import shutil
+import tempfile
+
+from pigpy.hadoop import Hadoop, HDFSError
+from util import fake_hadoop_home
+
+class test_hadoop(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hadoop = Hadoop(fake_hadoop_home(os.path.join(self.directory, "hadoop")),
+            "hdfs://fake:54310", [])
+
+        self.report_path = os.path.join(self.directory, "report")
+        os.makedirs(self.report_path)
+        for part, lines in [("part-00000", "a,1\nb,2\n"), ("part-00001", "c,3\n")]:
+            open(os.path.join(self.report_path, part), "w").write(lines)
+        self.local_filename = os.path.join(self.directory, "report.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_report_folder_is_concatenated_under_header(self):
+        size = self.hadoop.copy_pig_report_to_file(self.report_path, self.local_filename,
+            header="letter,number")
+
+        contents = open(self.local_filename).read()
+        self.assertEqual(contents, "letter,number\na,1\nb,2\nc,3\n")
+        self.assertEqual(size, len(contents))
+
+    def test_single_file_report_is_copied(self):
+        self.hadoop.copy_pig_report_to_file(
+            os.path.join(self.report_path, "part-00001"), self.local_filename)
+
+        self.assertEqual(open(self.local_filename).read(), "c,3\n")
+
+    def test_report_can_be_gzipped_on_the_way(self):
+        self.hadoop.copy_pig_report_to_file(self.report_path, self.local_filename,
+            header="letter,number", compress=True)
+
+        self.assertEqual(gzip.open(self.local_filename).read(),
+            "letter,number\na,1\nb,2\nc,3\n")
+
+    def test_failed_copy_leaves_no_partial_report(self):
+        self.assertRaises(HDFSError, self.hadoop.copy_pig_report_to_file,
+            os.path.join(self.directory, "missing"), self.local_filename)
+        self.failIf(os.path.exists(self.local_filename))
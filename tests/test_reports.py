@@ -2,8 +2,29 @@ import sys
 import os
 import unittest
 import re
+import shutil
+import tempfile
+import threading
+import time
 
-from pigpy.reports import Report, Plan
+from pigpy.reports import Report, Plan, PlanRunner, SaveReportsError
+from pigpy.hadoop import HDFSError
+
+class FetchingHadoop(object):
+    """Pretends to copy reports, failing for any report named in failures"""
+    def __init__(self, failures=()):
+        self.failures = failures
+        self.fetched = []
+        self.threads = set()
+
+    def copy_pig_report_to_file(self, report_path, local_filename, header=None):
+        self.threads.add(threading.current_thread())
+        #Give the other workers a chance to pick up a report
+        time.sleep(0.01)
+        if os.path.basename(report_path) in self.failures:
+            raise HDFSError("hdfs command returned error code 255")
+        self.fetched.append(os.path.basename(local_filename))
+        return 10
 
 class test_reports(unittest.TestCase):
     def setUp(self):
@@ -123,3 +144,84 @@ class test_reports(unittest.TestCase):
         repeated_report = Report("repeated_report", "same random code")
         
         self.assertEqual(report.name, repeated_report.name)
+
+    def test_reports_created_in_a_loop_get_sequential_names(self):
+        reports = [Report("looped_report", "code %s" % i) for i in range(5)]
+
+        self.assertEqual([report.name for report in reports],
+            ["looped_report"] + ["looped_report_%s" % i for i in range(1, 5)])
+
+    def test_generated_names_skip_names_already_taken(self):
+        taken = Report("taken_report_1", "explicitly named")
+        first = Report("taken_report", "first code")
+        second = Report("taken_report", "second code")
+
+        self.assertEqual(second.name, "taken_report_2")
+
+    def test_duplicate_of_renamed_report_gets_the_renamed_name(self):
+        first = Report("renamed_report", "first code")
+        second = Report("renamed_report", "second code")
+        duplicate = Report("renamed_report", "second code")
+
+        self.assertEqual(duplicate.name, second.name)
+
+    def test_reports_with_different_parents_are_not_duplicates(self):
+        first_parent = Report("first_parent", "parent code")
+        second_parent = Report("second_parent", "parent code")
+        first = Report("same_child", "%(this)s = %(parent)s", parents={"parent": first_parent})
+        second = Report("same_child", "%(this)s = %(parent)s", parents={"parent": second_parent})
+
+        self.assertNotEqual(first.name, second.name)
+
+    def test_deep_dependency_chain_does_not_hit_recursion_limit(self):
+        report = Report("deep_chain", "%(this)s")
+        for i in range(sys.getrecursionlimit() * 2):
+            report = Report("deep_chain", "%(this)s = %(parent)s", parents={"parent": report})
+
+        plan = Plan(reports=[report])
+        self.failUnless(plan.pigfile.startswith("deep_chain\n"),
+            "Chain should start with its root report, pigfile starts with:\n%s" %
+            plan.pigfile[:100]
+        )
+
+    def test_pigfile_is_regenerated_only_when_reports_are_added(self):
+        first = Report("memoized_first", "%(this)s")
+        second = Report("memoized_second", "%(this)s")
+
+        plan = Plan(reports=[first])
+        pigfile = plan.pigfile
+        self.failUnless(plan.pigfile is pigfile)
+
+        plan.add(second)
+        self.failIf(plan.pigfile is pigfile)
+        self.failUnless("memoized_second" in plan.pigfile)
+
+
+class test_plan_runner(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.reports = [Report("fetched_%s" % i, "%(this)s") for i in range(6)]
+        self.plan = Plan(reports=self.reports)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_all_reports_are_fetched_in_parallel(self):
+        hadoop = FetchingHadoop()
+        results = PlanRunner(self.plan, hadoop).save_reports(self.folder, max_workers=3)
+
+        self.assertEqual(sorted(hadoop.fetched), sorted(report.name for report in self.reports))
+        self.failUnless(len(hadoop.threads) > 1)
+        self.assertEqual(results[self.reports[0].name]["bytes"], 10)
+
+    def test_failed_fetch_does_not_stop_other_reports(self):
+        failed = self.reports[1].name
+        hadoop = FetchingHadoop(failures=[failed])
+        try:
+            PlanRunner(self.plan, hadoop).save_reports(self.folder, max_workers=3)
+            self.fail("Failed report should raise SaveReportsError")
+        except SaveReportsError, e:
+            self.failUnless(isinstance(e.results[failed]["error"], HDFSError))
+            self.failUnless(failed in str(e))
+
+        self.assertEqual(len(hadoop.fetched), len(self.reports) - 1)
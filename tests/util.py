@@ -1,3 +1,5 @@
+import os
+import sys
 from tempfile import NamedTemporaryFile
 import subprocess
 
@@ -19,4 +21,15 @@ def report_diff(correct_report_path, test_report_path):
     result = subprocess.Popen(["diff", "-b", sorted_correct.name, sorted_test.name],
         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     result.wait()
-    return "".join(result.stdout)
\ No newline at end of file
+    return "".join(result.stdout)
+def fake_hadoop_home(directory):
+    """Make directory look like a hadoop install whose bin/hadoop is fake_hadoop.py"""
+    bin_directory = os.path.join(directory, "bin")
+    os.makedirs(bin_directory)
+    hadoop_binary = os.path.join(bin_directory, "hadoop")
+    script = open(hadoop_binary, "w")
+    script.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_hadoop.py")))
+    script.close()
+    os.chmod(hadoop_binary, 0755)
+    return directory